@@ -1,133 +1,458 @@
-import csv
-import requests
-import time
+import asyncio
+import httpx
+from aiolimiter import AsyncLimiter
 import logging
+import mmap
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import os
-import json
-from requests.auth import HTTPBasicAuth
+import orjson
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 
+try:
+    import uvloop  # 以 libuv 實作的事件迴圈，socket I/O 與排程較快；Windows 不支援
+except ImportError:
+    uvloop = None
+
+# 日誌與失敗 ticket 清單的輸出目錄
+LOG_DIR = "adata_fs_automation_logs"
+# 同時進行中的請求上限
+MAX_CONCURRENCY = 64
+# 讀取 CSV 與發送請求之間的佇列長度，限制尚未處理的 ticket ID 佔用的記憶體
+QUEUE_SIZE = 1024
+# CSV 尚未讀取完畢（總數未知）時，每檢查多少個 ticket 以 INFO 記錄一次進度；
+# 讀取完畢後改為每 1% 記錄一次。逐筆的跳過與成功訊息只在 DEBUG 層級輸出
+PROGRESS_EVERY = 100
+# Freshservice API 每分鐘請求上限（依方案不同），略低於官方額度以保留誤差空間；
+# 實際以每秒 RATE_LIMIT / RATE_PERIOD 個的平均速率送出，burst 只有約 0.1 秒的額度
+RATE_LIMIT = 300
+RATE_PERIOD = 60
+# THROTTLE_WINDOW 秒內收到 THROTTLE_429_COUNT 次 429 才調降速率（每次降為 80%），
+# 調降後 RECOVER_AFTER 秒沒有 429 則每次回升 10%，直到回到設定的速率
+THROTTLE_429_COUNT = 3
+THROTTLE_WINDOW = 10
+RECOVER_AFTER = 30
+# 遇到 429 / 5xx / 連線錯誤時的最大嘗試次數
+MAX_RETRIES = 5
+# 單一請求各階段（連線、讀取、寫入、等待連線池）的逾時秒數
+REQUEST_TIMEOUT = 30
+# 記錄 send_to_dxdb_statuscode 已是 200 的 ticket ID 的本地快取（依 base_url 分開存放），
+# 重新執行時跳過這些 ticket 的 GET 與 PUT
+PROCESSED_CACHE = 'processed_tickets.json'
+# 每新增多少筆已確認 200 的 ticket 就寫回快取一次
+CACHE_FLUSH_EVERY = 100
+
+# 觸發 DXDB 更新 workflow 的 PUT body，內容固定，於模組載入時序列化一次
+_PUT_BODY = orjson.dumps({
+    "custom_fields": {
+        "trigger_mc_workflow_to_update_dxdb_via_api": True
+    }
+})
+_PUT_HEADERS = {"Content-Type": "application/json"}
+# 確定請求尚未送出的連線錯誤；PUT 只在這些錯誤時重試，其他傳輸錯誤（讀寫逾時、連線中斷等）
+# 發生時伺服器可能已套用更新，重試會重複觸發 DXDB workflow
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class AdaptiveLimiter(AsyncLimiter):
+    """平均速率為 rate_limit / rate_period、burst 只有約 0.1 秒額度的 AsyncLimiter；
+    持續收到 429 時就地調降速率（保留 bucket 目前的水位，不會重新開放一整個 burst），
+    一段時間沒有 429 後再逐步回到設定的速率"""
+
+    def __init__(self, rate_limit, rate_period):
+        # aiolimiter 的 bucket 容量等於 max_rate，直接用 (300, 60) 會在開頭一次放行 300 個請求，
+        # 第一分鐘最多送出 600 個；改以約 0.1 秒的額度建立 bucket，平均速率相同但 burst 很小，
+        # 即使 API 以每秒固定視窗計算額度，第一個視窗也不會超出
+        self.base_rate = rate_limit / rate_period
+        capacity = max(1.0, self.base_rate / 10)  # 每個請求需要 1 單位額度，容量至少為 1
+        super().__init__(capacity, capacity / self.base_rate)
+        self._throttled = deque()  # THROTTLE_WINDOW 內收到 429 的時間
+        self._last_throttled = float('-inf')
+        self._last_change = float('-inf')  # 上次調整速率的時間
+
+    @property
+    def rate(self):
+        """目前每秒允許的請求數"""
+        return self._rate_per_sec
+
+    def _set_rate(self, rate):
+        self._leak()  # 先以原速率結算到目前為止流出的額度，bucket 容量與水位不變
+        self._rate_per_sec = rate
+        return rate
+
+    def on_throttled(self):
+        """記錄一次 429，持續收到 429 時調降速率；回傳調降後的速率，未調降時回傳 None"""
+        now = time.monotonic()
+        self._last_throttled = now
+        self._throttled.append(now)
+        while now - self._throttled[0] > THROTTLE_WINDOW:
+            self._throttled.popleft()
+        # 同一批併發請求同時收到的 429 只會調降一次
+        if len(self._throttled) < THROTTLE_429_COUNT or now - self._last_change < THROTTLE_WINDOW:
+            return None
+        self._throttled.clear()
+        self._last_change = now
+        return self._set_rate(max(self.base_rate * 0.1, self._rate_per_sec * 0.8))
+
+    def on_success(self):
+        """速率已調降且 RECOVER_AFTER 秒內沒有 429 時回升 10%；回傳回升後的速率，未調整時回傳 None"""
+        if self._rate_per_sec >= self.base_rate:
+            return None
+        now = time.monotonic()
+        if now - max(self._last_throttled, self._last_change) < RECOVER_AFTER:
+            return None
+        self._last_change = now
+        return self._set_rate(min(self.base_rate, self._rate_per_sec * 1.1))
+
+@dataclass(frozen=True)
+class Config:
+    """config.json 的設定值，載入時即驗證必要欄位"""
+    username: str
+    password: str
+    base_url: str
+    csv_path: str
+    concurrency: int = MAX_CONCURRENCY
+    rate_limit: int = RATE_LIMIT
+
+    def __post_init__(self):
+        # concurrency 為 0 時不會啟動任何 worker，rate_limit 為 0 時無法取得任何請求額度
+        for name in ('concurrency', 'rate_limit'):
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                raise ValueError(f"config.json 欄位 api.{name} 必須為正整數: {value!r}")
+
 def load_config():
     try:
-        with open('config.json', 'r') as file:
-            config = json.load(file)
-        logging.info("成功載入配置文件")
-        return config
+        with open('config.json', 'rb') as file:
+            data = orjson.loads(file.read())
     except FileNotFoundError:
         raise FileNotFoundError("找不到 config.json 文件")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise ValueError("config.json 格式錯誤，請檢查 JSON 格式")
     except Exception as e:
         raise Exception(f"載入配置文件時發生錯誤: {str(e)}")
 
+    try:
+        api = data['api']
+        config = Config(
+            username=data['credentials']['username'],
+            password=data['credentials']['password'],
+            base_url=api['base_url'],
+            csv_path=data['csv']['file_path'],
+            concurrency=api.get('concurrency', MAX_CONCURRENCY),
+            rate_limit=api.get('rate_limit', RATE_LIMIT)
+        )
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"config.json 缺少必要欄位: {str(e)}")
+    logging.info("成功載入配置文件")
+    return config
+
 def setup_logging():
     """設置日誌記錄"""
     # 創建logs目錄（如果不存在）
-    log_dir = "adata_fs_automation_logs"
-    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
 
     # 設置日誌文件名（包含時間戳）adata_fs_automation_logs/ticket_update_20240101_143045.log
     log_filename = os.path.join(
-        log_dir,
+        LOG_DIR,
         f'ticket_update_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
     )
 
-    # 設置日誌格式，之後的 logging 調用都會使用這個配置
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        #Handler 決定日誌訊息要輸出到哪裡
-        handlers=[ 
-            # 文件處理器，將日誌寫入到文件中
-            logging.FileHandler(log_filename, encoding='utf-8'),
-            # 控制台處理器，將日誌輸出到控制台（終端）用於即時查看日誌
-            logging.StreamHandler()
-        ]
-    )
+    # 設置日誌格式
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    #Handler 決定日誌訊息要輸出到哪裡
+    # 文件處理器，將日誌寫入到文件中
+    file_handler = logging.FileHandler(log_filename, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    # 控制台處理器，將日誌輸出到控制台（終端）用於即時查看日誌
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    # 之後的 logging 調用只會把紀錄放進佇列，由 listener 在背景執行緒寫入文件與終端，
+    # 請求迴圈不會因為磁碟 I/O 而阻塞
+    log_queue = queue.Queue(-1)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    # httpx 會以 INFO 記錄每一個請求，只保留警告以上的訊息
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
 
     logging.info(f"日誌文件位置: {os.path.abspath(log_filename)}")
-    return log_filename
+    return log_filename, listener
 
 class TicketUpdater:
-    def __init__(self, username, password, base_url):
-        self.auth = HTTPBasicAuth(username, password)
+    def __init__(self, username, password, base_url, concurrency=MAX_CONCURRENCY,
+                 rate_limit=RATE_LIMIT, rate_period=RATE_PERIOD):
+        self.auth = httpx.BasicAuth(username, password)
         self.base_url = base_url
-        self.session = requests.Session()
-        self.session.auth = self.auth
+        # URL 模板只在初始化時建立一次，避免每個 ticket 重新組字串
+        # Freshservice v2 的 ticket 查詢沒有欄位篩選參數（include= 只會額外加入 stats 等資料），
+        # 因此不帶任何 query 的單筆查詢已是最小回應；httpx 預設帶 Accept-Encoding 以 gzip 傳輸
+        self._check_tpl = f"{base_url}/{{}}"
+        self._update_tpl = f"{base_url}/{{}}/?bypass_mandatory=true"
+        self.concurrency = concurrency
+        self.client = None  # 在 process_csv 中建立，AsyncClient 的連線池綁定事件迴圈
+        self.semaphore = None
+        self.limiter = AdaptiveLimiter(rate_limit, rate_period)  # token bucket，GET 與 PUT 共用同一額度
+        self.total_tickets = 0
+        self.checked_count = 0
+        self._csv_done = False  # CSV 讀取完畢後 total_tickets 才是最終總數
         self.success_count = 0
         self.failure_count = 0
-        self.error_tickets = []  # 記錄失敗的ticket ID
+        self.error_log = os.path.join(LOG_DIR, 'error_tickets.txt')
+        self._error_fp = None  # 失敗的ticket ID 在處理過程中逐筆寫入，程式中斷也不會遺失
+        self._cache = {}  # 快取檔案內容：{base_url: [ticket ID, ...]}，保留其他站台的紀錄
+        self._done = self._load_done()  # 此 base_url 在先前執行中已確認為 200 的ticket ID
+        self._unsaved = 0
 
-    def update_ticket(self, ticket_id):
-        check_url = f"{self.base_url}/{ticket_id}"
-        
+    def _load_done(self):
+        """載入此 base_url 已確認 200 的ticket ID，檔案不存在或格式錯誤時從空集合開始"""
         try:
-            check_response = self.session.get(check_url)
-            check_response.raise_for_status()
-            ticket_data = check_response.json()
-        
-            # 取得send_to_dxdb_statuscode欄位
-            status_code = ticket_data.get('ticket', {}).get('custom_fields', {}).get('send_to_dxdb_statuscode')
-            
-            # 如果狀態碼是 200，則跳過此 ticket。當執行到 return True 時，函數立即結束。
-            if status_code == 200:
-                logging.info(f"Ticket {ticket_id} 的 send_to_dxdb_statuscode 已是 200，跳過更新")
-                return True 
-            else:
-                #更新單個ticket的函數
-                url = f"{self.base_url}/{ticket_id}/?bypass_mandatory=true"
-                payload = {
-                    "custom_fields": {
-                        "trigger_mc_workflow_to_update_dxdb_via_api": True
-                    }
-                }
-
-                response = self.session.put(url, json=payload)
-                response.raise_for_status() #檢查 HTTP 響應的狀態碼
-                self.success_count += 1
-                logging.info(f"成功更新 Ticket {ticket_id}")
-                return True
-        except requests.exceptions.RequestException as e: # 捕獲所有可能的請求異常
-            self.failure_count += 1
-            self.error_tickets.append(ticket_id)  # 記錄失敗的ticket ID
-            logging.error(f"更新 Ticket {ticket_id} 時發生錯誤: {str(e)}")
+            with open(PROCESSED_CACHE, 'rb') as file:
+                cache = orjson.loads(file.read())
+            if not isinstance(cache, dict):
+                raise TypeError
+            done = set(cache.get(self.base_url, []))
+        except FileNotFoundError:
+            return set()
+        except (ValueError, TypeError):
+            logging.warning(f"{PROCESSED_CACHE} 格式錯誤，忽略快取")
+            return set()
+        self._cache = cache
+        logging.info(f"從 {PROCESSED_CACHE} 載入 {len(done)} 個已確認 200 的 tickets")
+        return done
+
+    def _save_done(self):
+        """將快取寫入暫存檔後再取代，避免中途中斷造成快取損毀"""
+        self._cache[self.base_url] = sorted(self._done)
+        tmp_path = f"{PROCESSED_CACHE}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps(self._cache))
+        os.replace(tmp_path, PROCESSED_CACHE)
+        self._unsaved = 0
+
+    def _mark_done(self, ticket_id):
+        self._done.add(ticket_id)
+        self._unsaved += 1
+        if self._unsaved >= CACHE_FLUSH_EVERY:
+            self._save_done()
+
+    def _retry_after(self, headers, attempt):
+        """依 Retry-After 或 X-RateLimit-Reset 標頭計算 429 後需等待的秒數"""
+        retry_after = headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        reset = headers.get('X-RateLimit-Reset')
+        if reset:
+            try:
+                return max(0.0, float(reset) - time.time())
+            except ValueError:
+                pass
+        return 2 ** attempt + random.random()
+
+    async def _request(self, method, url, **kwargs):
+        """發送請求並回傳 response body，遇到 429 / 5xx / 連線錯誤時自動重試（PUT 只重試尚未送出的連線錯誤）"""
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                async with self.semaphore, self.limiter: # semaphore 限制同時進行中的請求數量
+                    response = await self.client.request(method, url, **kwargs)
+                if response.status_code == 429:
+                    wait = self._retry_after(response.headers, attempt)
+                    if (rate := self.limiter.on_throttled()) is not None:
+                        logging.warning(f"持續收到 429，請求速率調降為每秒 {rate:.2f} 個")
+                elif response.status_code >= 500:
+                    wait = 2 ** attempt + random.random()
+                else:
+                    response.raise_for_status() #檢查 HTTP 響應的狀態碼，4xx 不重試
+                    if (rate := self.limiter.on_success()) is not None:
+                        logging.info(f"一段時間未收到 429，請求速率回升為每秒 {rate:.2f} 個")
+                    return response.content
+                reason = f"HTTP {response.status_code}"
+                if attempt == MAX_RETRIES:
+                    response.raise_for_status()
+            except httpx.TransportError as e: # 連線錯誤與逾時
+                if attempt == MAX_RETRIES or (method == 'PUT' and not isinstance(e, _NOT_SENT_ERRORS)):
+                    raise
+                wait = 2 ** attempt + random.random()
+                reason = str(e) or type(e).__name__
+            logging.warning(f"{method} {url} 失敗 ({reason})，{wait:.1f} 秒後重試 ({attempt}/{MAX_RETRIES})")
+            await asyncio.sleep(wait)
+
+    def _record_failure(self, ticket_id, message):
+        self.failure_count += 1
+        self._error_fp.write(f"{ticket_id}\n")  # 記錄失敗的ticket ID
+        logging.error(message)
+
+    async def _check_status(self, ticket_id):
+        """檢查 ticket 是否需要更新：需要更新回傳 True，已是 200 回傳 False，查詢失敗回傳 None"""
+        # 先前執行中已確認為 200 的 ticket 不再發送任何請求
+        if ticket_id in self._done:
+            logging.debug("Ticket %s 已在先前執行中確認為 200，跳過", ticket_id)
             return False
 
-    def process_csv(self, csv_file_path, delay=5):
-        """處理CSV文件中的所有tickets"""
         try:
-            ticket_ids = []
-            with open(csv_file_path, 'r') as file:
-                csv_reader = csv.reader(file) #返回一個迭代器物件。每次迭代返回一個列表,代表 CSV 文件中的一行
+            ticket_data = orjson.loads(await self._request('GET', self._check_tpl.format(ticket_id)))
+        except (httpx.HTTPError, ValueError) as e: # 重試後仍失敗的請求異常或無效的 JSON（orjson.JSONDecodeError 為 ValueError 子類別）
+            self._record_failure(ticket_id, f"查詢 Ticket {ticket_id} 時發生錯誤: {str(e)}")
+            return None
+
+        # 取得send_to_dxdb_statuscode欄位
+        # ticket 或 custom_fields 可能為 null
+        status_code = ((ticket_data.get('ticket') or {}).get('custom_fields') or {}).get('send_to_dxdb_statuscode')
+
+        # 如果狀態碼是 200，則跳過此 ticket
+        if status_code == 200:
+            logging.debug("Ticket %s 的 send_to_dxdb_statuscode 已是 200，跳過更新", ticket_id)
+            self._mark_done(ticket_id)
+            return False
+        return True
+
+    async def _do_update(self, ticket_id):
+        """更新單個ticket，觸發 DXDB 更新 workflow"""
+        try:
+            await self._request(
+                'PUT',
+                self._update_tpl.format(ticket_id),
+                content=_PUT_BODY,
+                headers=_PUT_HEADERS
+            )
+        except httpx.HTTPError as e: # 重試後仍失敗的請求異常
+            self._record_failure(ticket_id, f"更新 Ticket {ticket_id} 時發生錯誤: {str(e)}")
+            return False
+        # PUT 成功只代表已觸發 workflow，狀態碼是否變成 200 要等下次執行查詢後才寫入快取
+        self.success_count += 1
+        logging.debug("成功更新 Ticket %s", ticket_id)
+        return True
+
+    async def _produce(self, csv_file_path, check_queue):
+        """逐行讀取CSV，將ticket ID放入佇列，讓請求在讀檔的同時開始進行"""
+        first_ticket = last_ticket = None
+        skipped = 0
+        with open(csv_file_path, 'rb') as file:
+            # mmap 無法映射空檔案
+            if os.fstat(file.fileno()).st_size == 0:
+                return first_ticket, last_ticket
+            # 只需要第一欄，直接在 mmap 上逐行切出第一個逗號前的內容，省去 csv.reader 的通用解析成本
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
                 # 跳過標題行
-                next(csv_reader)
-                # 讀取所有ticket IDs（只讀第一列）
-                for row in csv_reader:
-                    if row and row[0].strip():  # 確保行不為空且第一個欄位有值
-                        ticket_ids.append(row[0].strip())
+                mm.readline()
+                for line in iter(mm.readline, b''):
+                    # 去除空白、換行（含 \r\n）與引號；空行或第一欄為空時跳過
+                    ticket_id = line.split(b',', 1)[0].strip(b' \t\r\n"')
+                    if not ticket_id:
+                        continue
+                    # 逐行切割不處理引號內的換行，其他欄位含換行時接續的行會被當成一列；
+                    # ticket ID 一定是數字，非數字的值直接略過，避免對假的 ID 發送請求
+                    if not ticket_id.isdigit():
+                        skipped += 1
+                        continue
+                    ticket_id = ticket_id.decode()
+                    if first_ticket is None:
+                        first_ticket = ticket_id
+                    last_ticket = ticket_id
+                    self.total_tickets += 1
+                    await check_queue.put(ticket_id)
+        if skipped:
+            logging.warning(f"略過 {skipped} 行第一欄不是數字的資料（可能是其他欄位內換行的內容）")
+        return first_ticket, last_ticket
+
+    def _log_progress(self):
+        """CSV 讀取完畢前每 PROGRESS_EVERY 個 ticket、讀取完畢後每 1% 記錄一次進度"""
+        count = self.checked_count
+        if self._csv_done:
+            total = self.total_tickets
+            if count == total or count % max(1, total // 100) == 0:
+                logging.info("處理進度: %d/%d (%.1f%%)", count, total, count / total * 100)
+        elif count % PROGRESS_EVERY == 0:
+            logging.info("處理進度: 已檢查 %d 個 tickets", count)
+
+    async def _check_worker(self, check_queue, update_queue):
+        """第一階段：查詢ticket狀態，需要更新的ticket交給第二階段"""
+        while (ticket_id := await check_queue.get()) is not None:
+            # 未預期的錯誤只讓該 ticket 失敗，worker 必須繼續消化佇列，否則讀檔端會卡在 put
+            try:
+                needs_update = await self._check_status(ticket_id)
+            except Exception as e:
+                self._record_failure(ticket_id, f"查詢 Ticket {ticket_id} 時發生未預期的錯誤: {str(e)}")
+                needs_update = False
+            self.checked_count += 1
+            self._log_progress()
+            if needs_update:
+                await update_queue.put(ticket_id)
 
-            if not ticket_ids: #如果 ticket_ids 是空列表
+    async def _update_worker(self, update_queue):
+        """第二階段：對需要更新的ticket發送PUT"""
+        while (ticket_id := await update_queue.get()) is not None:
+            try:
+                await self._do_update(ticket_id)
+            except Exception as e:
+                self._record_failure(ticket_id, f"更新 Ticket {ticket_id} 時發生未預期的錯誤: {str(e)}")
+
+    async def process_csv(self, csv_file_path):
+        """處理CSV文件中的所有tickets"""
+        try:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            self._error_fp = open(self.error_log, 'w', buffering=1)  # 行緩衝，每筆失敗立即寫入磁碟
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            # 啟用 HTTP/2，併發請求在同一條 TLS 連線上多工傳輸，減少連線數與 TLS 握手；
+            # 連線池上限與併發數一致，伺服器只支援 HTTP/1.1 時仍可維持相同的併發量
+            limits = httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+                keepalive_expiry=30
+            )
+            async with httpx.AsyncClient(
+                http2=True,
+                auth=self.auth,
+                limits=limits,
+                timeout=httpx.Timeout(REQUEST_TIMEOUT)
+            ) as client:
+                self.client = client
+                # 兩個階段同時運作：檢查完成的 ticket 立即交給更新 worker，不必等整批 GET 結束；
+                # 不預先發送 PUT，因為對已是 200 的 ticket 重複觸發 workflow 會造成重複寫入 DXDB
+                check_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+                update_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+                checkers = [
+                    asyncio.create_task(self._check_worker(check_queue, update_queue))
+                    for _ in range(self.concurrency)
+                ]
+                updaters = [
+                    asyncio.create_task(self._update_worker(update_queue))
+                    for _ in range(self.concurrency)
+                ]
+                try:
+                    logging.info("開始處理，邊讀取CSV邊發送請求")
+                    first_ticket, last_ticket = await self._produce(csv_file_path, check_queue)
+                    self._csv_done = True
+
+                    # 每個 worker 收到 None 即結束；第一階段全部結束後才通知第二階段
+                    for _ in checkers:
+                        await check_queue.put(None)
+                    await asyncio.gather(*checkers)
+                    for _ in updaters:
+                        await update_queue.put(None)
+                    await asyncio.gather(*updaters)
+                finally:
+                    for task in checkers + updaters:
+                        task.cancel()
+                    if self._unsaved:
+                        self._save_done()
+
+            if not self.total_tickets: #如果CSV中沒有任何ticket ID
                 logging.error("CSV文件中沒有找到有效的Ticket IDs")
                 return
 
-            total_tickets = len(ticket_ids)
-            logging.info(f"開始處理，總計 {total_tickets} 個 tickets")
-            logging.info(f"第一個Ticket ID: {ticket_ids[0]}")
-            logging.info(f"最後一個Ticket ID: {ticket_ids[-1]}")
-
-            for index, ticket_id in enumerate(ticket_ids, 1):
-                logging.info(f"處理進度: {index}/{total_tickets} ({(index/total_tickets)*100:.2f}%)")
-                self.update_ticket(ticket_id)
-                
-                if index < total_tickets:  # 不在最後一個請求後等待
-                    time.sleep(delay)
-
-            # 處理完成後，記錄失敗的cases
-            if self.error_tickets:
-                error_log = os.path.join('logs', 'error_tickets.txt')
-                with open(error_log, 'w') as f:
-                    f.write('\n'.join(self.error_tickets))
-                logging.info(f"失敗的Ticket ID已記錄到: {error_log}")
+            logging.info(f"總計 {self.total_tickets} 個 tickets")
+            logging.info(f"第一個Ticket ID: {first_ticket}")
+            logging.info(f"最後一個Ticket ID: {last_ticket}")
+
+            if self.failure_count:
+                logging.info(f"失敗的Ticket ID已記錄到: {self.error_log}")
 
             logging.info(f"處理完成！成功: {self.success_count}, 失敗: {self.failure_count}")
 
@@ -135,29 +460,36 @@ class TicketUpdater:
             logging.error(f"找不到CSV文件: {csv_file_path}")
         except Exception as e:
             logging.error(f"處理CSV時發生錯誤: {str(e)}")
+        finally:
+            if self._error_fp:
+                self._error_fp.close()
 
 def main():
+    # 設置日誌
+    log_file, log_listener = setup_logging()
     try:
-        # 設置日誌
-        log_file = setup_logging()
         logging.info(f"開始執行程式")
         
         # 取得配置值
         config = load_config()
-        credentials = config.get('credentials', {})
-        api = config.get('api', {})
-        csv = config.get('csv', {})   
-        
+
         updater = TicketUpdater(
-            username=credentials['username'],
-            password=credentials['password'],
-            base_url=api['base_url']
+            username=config.username,
+            password=config.password,
+            base_url=config.base_url,
+            concurrency=config.concurrency,
+            rate_limit=config.rate_limit
         )
-        updater.process_csv(csv_file_path=csv['file_path'])
+        # 有安裝 uvloop 時使用 uvloop 執行，否則退回標準 asyncio 事件迴圈
+        run = uvloop.run if uvloop else asyncio.run
+        run(updater.process_csv(csv_file_path=config.csv_path))
         
         logging.info(f"程式執行完成，日誌文件位置: {log_file}")
     except Exception as e:
         logging.error(f"程式執行時發生未預期的錯誤: {str(e)}")
+    finally:
+        # 停止前會先寫完佇列中剩餘的日誌
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file